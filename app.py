@@ -1,18 +1,28 @@
 
 import urllib.parse
+import hashlib
+import uuid
 import base64
 import io
 
+import flask
+
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 
 import pandas as pd
 
-from preprocess import preprocess, calculate_pairwise_similarities
-from constants import functional_groups, reaction_classes
+from preprocess import preprocess, fp_column, hex_to_fps, FP_TYPES
+from depict import depict, MIMETYPES
+from library import is_library_file, read_library, library_to_bytes
+from similarity import get_similarity_cache
+from group_counts import get_group_index
+from registry import Registry
+from constants import functional_groups, reaction_classes, fingerprint_types
 
 app = dash.Dash(
     __name__,
@@ -29,6 +39,7 @@ server = app.server
 
 func_group_options = [{'label': group, 'value': value} for group, value in functional_groups.items()]
 reaction_class_options = [{'label': group, 'value': value} for group, value in reaction_classes.items()]
+fingerprint_type_options = [{'label': name, 'value': value} for name, value in fingerprint_types.items()]
 
 header = html.Div(
     [
@@ -141,6 +152,8 @@ upload_button = dcc.Upload(
     multiple=True,
 )
 
+upload_error = dbc.Alert(id='upload-error', color='danger', dismissable=True, is_open=False, className='upload-error')
+
 
 export_button = dbc.Button(
     [
@@ -150,6 +163,48 @@ export_button = dbc.Button(
     size='lg', outline=True, className='button-export'
 )
 
+export_library_button = dbc.Button(
+    [
+        html.Img(src='./assets/download.svg', className='button-img'),
+        html.A('Export Library', id='library-download-link', download='library.parquet', href='', target='_blank'),
+    ],
+    size='lg', outline=True, className='button-export'
+)
+
+export_library_tooltip = dbc.Tooltip(
+    'Export the filtered, preprocessed dataset as Parquet. Re-importing it skips preprocessing.',
+    target='library-download-link',
+)
+
+GRID_PAGE_SIZE = 24
+
+molecule_grid = html.Div(
+    [
+        html.Div(
+            [
+                html.H6('Filtered Molecules', className='plot-header-text'),
+            ],
+            className='plot-header', id='plot-header-5'),
+        dbc.Tooltip('2D structures of the filtered DB building blocks, one page at a time.',
+                    target='plot-header-5'),
+        html.Div(
+            [
+                dbc.Button('Previous', id='grid-previous', size='sm', outline=True, className='button-grid'),
+                html.Span(id='grid-page-label', className='grid-page-label'),
+                dbc.Button('Next', id='grid-next', size='sm', outline=True, className='button-grid'),
+            ],
+            className='grid-controls'
+        ),
+        dcc.Loading(
+            type='default',
+            children=[html.Div(id='molecule-grid', className='molecule-grid')],
+            className='spinner'
+        ),
+        dcc.Store(id='grid-page', data=0),
+    ],
+    className='plot-container grid-container'
+)
+
 explainer = html.Div(
     [
         html.Hr(),
@@ -160,7 +215,7 @@ explainer = html.Div(
                         [
                             html.H4('1. Import'),
                             html.Img(src='./assets/upload-blk1.svg', className='explainer-img'),
-                            html.P('a .csv of SMILES strings to be filtered'),
+                            html.P('a .csv of SMILES strings or an exported library to be filtered'),
                         ],
                         lg=4,
 
@@ -194,7 +249,7 @@ explainer = html.Div(
 # LAYOUT #
 ##########
 
-app.layout = html.Div(
+layout = html.Div(
     [
         header,
         dbc.Row(
@@ -215,10 +270,13 @@ app.layout = html.Div(
                         html.Div(
                             [
                                 upload_button,
-                                export_button
+                                export_button,
+                                export_library_button,
+                                export_library_tooltip,
                             ],
                             className='button-container'
-                        )
+                        ),
+                        upload_error,
                     ],
                     lg=4,
                     className='column-left'
@@ -265,6 +323,14 @@ app.layout = html.Div(
                                     '''Calculated pairwise Tanimoto similarity distribution of DB building blocks
                                     (Can take significant time for large DBs, computed only for filtered dataset).''',
                                     target='plot-header-3'),
+                                dcc.Dropdown(
+                                    className='dropdown fp-type-select',
+                                    id='fp-type-select',
+                                    options=fingerprint_type_options,
+                                    value='morgan',
+                                    clearable=False,
+                                    searchable=False,
+                                ),
                                 dcc.Loading(
                                     type='default',
                                     children=[dcc.Graph(id='updating-graph3')],
@@ -295,7 +361,9 @@ app.layout = html.Div(
             ],
             className='column-container'
         ),
+        molecule_grid,
         html.Div(id='preprocessed-data-store', style={'display': 'none'}),
+        dcc.Store(id='dataset-key'),
         html.Div(id='filtered-data-store', style={'display': 'none'}),
         html.Div(id='export-data', style={'display': 'none'}),
         explainer
@@ -304,6 +372,53 @@ app.layout = html.Div(
 )
 
 
+def serve_layout():
+    # a fresh id per page load, so server-side caches can keep per-session state
+    return html.Div([layout, dcc.Store(id='session-id', data=str(uuid.uuid4()))])
+
+
+app.layout = serve_layout
+
+
+###############
+# DATA STORES #
+###############
+
+def read_data_store(json_data):
+    # fingerprints are hex strings, which must not be inferred as numbers
+    return pd.read_json(io.StringIO(json_data), orient='split', dtype={fp_column(fp_type): str for fp_type in FP_TYPES})
+
+
+def dataset_key(json_data):
+    # identifies an uploaded dataset for the server-side caches
+    return hashlib.md5(json_data.encode('utf-8')).hexdigest()
+
+
+# preprocessed datasets by key, so that callbacks only needing the dataset take the small
+# dataset-key store as input rather than the whole data store JSON
+MAX_DATASETS = 4
+_datasets = Registry(MAX_DATASETS)
+
+
+def register_dataset(json_data):
+    key = dataset_key(json_data)
+    _datasets.set(key, read_data_store(json_data))
+    return key
+
+
+def load_dataset(key, json_data=None):
+    '''
+    Return the dataset registered under key. If newer uploads have evicted it, it is read
+    back from json_data when given, or else the callback is not updated.
+    '''
+    if json_data is not None:
+        return _datasets.get_or_build(key, lambda: read_data_store(json_data))
+    data = _datasets.get(key)
+    if data is None:
+        raise PreventUpdate
+    return data
+
+
 ###########
 # FIGURES #
 ###########
@@ -353,6 +468,44 @@ def generate_histgram_content(x, x_filtered, title):
     }
 
 
+def generate_binned_histogram_content(bin_edges, counts, title):
+
+    bin_centres = (bin_edges[:-1] + bin_edges[1:]) / 2
+
+    data_array = [
+        {
+            'x': bin_centres.tolist(),
+            'y': counts.tolist(),
+            'width': float(bin_edges[1] - bin_edges[0]),
+            'type': 'bar',
+            'marker': {'color': '#9656a1'},
+            'name': 'filtered'
+        },
+    ]
+
+    return {
+        'data': data_array,
+        'layout': {
+            'autosize': True,
+            'automargin': True,
+            'showlegend': True,
+            'paper_bgcolor': 'rgb(0, 0, 0, 0)',
+            'plot_bgcolor': '#f7f7f7',
+            'barmode': 'overlay',
+            'font': {'color': 'grey'},
+            'height': '230',
+            'margin': dict(l=50, r=50, b=50, t=50, pad=0),
+            'yaxis': {'gridcolor': '#dedede'},
+            'legend': {
+                'x': 0.8,
+                'y': 1.0,
+                'bgcolor': '#f7f7f7',
+                'borderwidth': 0
+            }
+        }
+    }
+
+
 def generate_bargraph_content(x, x_filtered, title):
 
     y_data_filtered = [x_filtered[fg].sum() for fg in list(functional_groups.keys())]
@@ -431,6 +584,9 @@ def update_logp_output(value):
 @app.callback(
     [
         Output('preprocessed-data-store', 'children'),
+        Output('dataset-key', 'data'),
+        Output('upload-error', 'children'),
+        Output('upload-error', 'is_open'),
     ],
     [
         Input('upload-data', 'contents'),
@@ -448,18 +604,33 @@ def preprocess_upload(file_contents, file_name):
         decoded = base64.b64decode(content_string)
 
         try:
-            if 'csv' in file_name:
+            if is_library_file(file_name):
+                # Assume that the user uploaded an exported library, which is already preprocessed
+                data = read_library(decoded, file_name)
+                json_data = data.to_json(date_format='iso', orient='split')
+                return [json_data, register_dataset(json_data), None, False]
+            elif 'csv' in file_name:
                 # Assume that the user uploaded a CSV file
                 df = pd.read_csv(
                     io.StringIO(decoded.decode('utf-8')))
             elif 'xls' in file_name:
                 # Assume that the user uploaded an excel file
                 df = pd.read_excel(io.BytesIO(decoded))
+            else:
+                raise ValueError(f'Unsupported file type: {file_name}')
         except Exception as e:
             print(e)
-            return html.Div([
-                'There was an error processing this file - did you upload a .csv or excel file?'
-            ])
+            # keep the current dataset, and tell the user why the file was not loaded
+            return [
+                dash.no_update,
+                dash.no_update,
+                [
+                    'There was an error processing this file - did you upload a .csv, excel or library file?',
+                    html.Br(),
+                    str(e),
+                ],
+                True,
+            ]
 
         # preprocess uploaded data
         data = preprocess(df)
@@ -467,7 +638,9 @@ def preprocess_upload(file_contents, file_name):
     else:
         data = preprocess(pd.DataFrame({'smiles': []}))
 
-    return [data.to_json(date_format='iso', orient='split')]
+    # the dataset key is computed once here, rather than hashing the data store in every callback
+    json_data = data.to_json(date_format='iso', orient='split')
+    return [json_data, register_dataset(json_data), None, False]
 
 
 #############
@@ -483,6 +656,7 @@ def preprocess_upload(file_contents, file_name):
         Output('download-link', 'href'),
         Output('molecule-count', 'children'),
         Output('filtered-data-store', 'children'),
+        Output('library-download-link', 'href'),
     ],
     [
         Input('preprocessed-data-store', 'children'),
@@ -492,10 +666,15 @@ def preprocess_upload(file_contents, file_name):
         Input('slider-molwt', 'value'),
         Input('slider-logp', 'value'),
     ],
+    [
+        State('dataset-key', 'data'),
+        State('session-id', 'data'),
+    ],
 )
-def update_output(preprocessed_data, active_rxns, active_fgroups, inactive_fgroups, molwt_cutoff, logp_cutoff):
+def update_output(preprocessed_data, active_rxns, active_fgroups, inactive_fgroups, molwt_cutoff, logp_cutoff,
+                  data_key, session_id):
 
-    data = pd.read_json(preprocessed_data, orient='split')
+    data = load_dataset(data_key, preprocessed_data)
 
     # include reaction classes and functional groups
     filtered_data = pd.DataFrame(columns=data.columns)
@@ -518,6 +697,10 @@ def update_output(preprocessed_data, active_rxns, active_fgroups, inactive_fgrou
     csv_string = export_data.to_csv(index=False, encoding='utf-8')
     csv_string = 'data:text/csv;charset=utf-8,' + urllib.parse.quote(csv_string)
 
+    # the library file is only built when the export link is followed
+    filtered_json = filtered_data.to_json(date_format='iso', orient='split')
+    library_href = register_library_export(session_id, data_key, filtered_data.index)
+
     # retrieve figure contents
     logp_figure = generate_histgram_content(data['logp'], filtered_data['logp'], 'LogP')
     molwt_figure = generate_histgram_content(data['molwt'], filtered_data['molwt'], 'MolWt')
@@ -527,13 +710,107 @@ def update_output(preprocessed_data, active_rxns, active_fgroups, inactive_fgrou
         logp_figure,
         molwt_figure,
         fg_figure,
-        filtered_data.to_json(date_format='iso', orient='split'),
+        filtered_json,
         csv_string,
         f'molecule count: {len(filtered_data.smiles)}',
-        filtered_data.to_json(date_format='iso', orient='split'),
+        filtered_json,
+        library_href,
     ]
 
 
+##############
+# HIT COUNTS #
+##############
+
+def label_with_count(label, count, sign):
+    return f'{label} ({sign}{count})' if count else f'{label} (0)'
+
+
+@app.callback(
+    [
+        Output('rxn-class-select', 'options'),
+        Output('fgroup-class-select', 'options'),
+        Output('fgroup-class-exclude', 'options'),
+    ],
+    [
+        Input('dataset-key', 'data'),
+        Input('rxn-class-select', 'value'),
+        Input('fgroup-class-select', 'value'),
+        Input('fgroup-class-exclude', 'value'),
+        Input('slider-molwt', 'value'),
+        Input('slider-logp', 'value'),
+    ],
+)
+def update_group_counts(data_key, active_rxns, active_fgroups, inactive_fgroups, molwt_cutoff, logp_cutoff):
+
+    # per-group presence bitmasks are built once per uploaded dataset
+    groups = list(reaction_classes.values()) + list(functional_groups.values())
+    index = get_group_index(data_key, lambda: load_dataset(data_key), groups)
+
+    include_counts, exclude_counts = index.counts(
+        active_fgroups + active_rxns, inactive_fgroups, molwt_cutoff, logp_cutoff
+    )
+
+    # selecting an include option adds molecules, deselecting it removes them (and vice versa for exclusions)
+    def include_options(items, active):
+        return [
+            {'label': label_with_count(label, include_counts[value], '-' if value in active else '+'), 'value': value}
+            for label, value in items
+        ]
+
+    exclude_options = [
+        {
+            'label': label_with_count(label, exclude_counts[value], '+' if value in inactive_fgroups else '-'),
+            'value': value
+        }
+        for label, value in functional_groups.items()
+    ]
+
+    return [
+        include_options(reaction_classes.items(), active_rxns),
+        include_options(functional_groups.items(), active_fgroups),
+        exclude_options,
+    ]
+
+
+##################
+# LIBRARY EXPORT #
+##################
+
+# latest filtered rows of each session, by dataset key and row index, converted to a
+# library file only on download
+MAX_EXPORT_SESSIONS = 16
+_library_exports = Registry(MAX_EXPORT_SESSIONS)
+
+
+def register_library_export(session_id, data_key, rows):
+    _library_exports.set(session_id, (data_key, rows.to_numpy()))
+
+    # a new token per filter change only changes the URL, so the browser never reuses a stale download
+    return '/export/library?' + urllib.parse.urlencode({'session': session_id, 'v': uuid.uuid4().hex})
+
+
+@server.route('/export/library')
+def serve_library_export():
+
+    export = _library_exports.get(flask.request.args.get('session'))
+    if export is None:
+        flask.abort(404)
+
+    data_key, rows = export
+    data = _datasets.get(data_key)
+    if data is None:
+        flask.abort(404)
+
+    # export the full preprocessed dataset so that re-importing it skips preprocessing
+    library = library_to_bytes(data.loc[rows])
+
+    response = flask.Response(library, mimetype='application/octet-stream')
+    response.headers['Content-Disposition'] = 'attachment; filename=library.parquet'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
 ##############
 # SIMILARITY #
 ##############
@@ -544,20 +821,98 @@ def update_output(preprocessed_data, active_rxns, active_fgroups, inactive_fgrou
     ],
     [
         Input('filtered-data-store', 'children'),
+        Input('fp-type-select', 'value'),
+    ],
+    [
+        State('dataset-key', 'data'),
+        State('session-id', 'data'),
     ],
 )
-def update_similarity(filtered):
+def update_similarity(filtered, fp_type, data_key, session_id):
 
-    filtered_data = pd.read_json(filtered, orient='split')
+    filtered_data = read_data_store(filtered)
 
-    # calculate pairwise similarities of filtered data only
-    similarities = calculate_pairwise_similarities(filtered_data)
+    # similarity tiles are cached per uploaded dataset and fingerprint type, and the last
+    # selection per session, so only pairs involving molecules added to or removed from
+    # this session's filtered set are recalculated
+    cache = get_similarity_cache(
+        (data_key, fp_type),
+        lambda: hex_to_fps(load_dataset(data_key)[fp_column(fp_type)])
+    )
+    counts = cache.update(filtered_data.index, session_id)
 
     # retrieve figure contents
-    similarity_figure = generate_histgram_content(None, similarities, 'Pairwise Similarity')
+    similarity_figure = generate_binned_histogram_content(cache.bin_edges, counts, 'Pairwise Similarity')
 
     return [similarity_figure]
 
 
+#################
+# MOLECULE GRID #
+#################
+
+@app.callback(
+    [
+        Output('molecule-grid', 'children'),
+        Output('grid-page-label', 'children'),
+        Output('grid-page', 'data'),
+    ],
+    [
+        Input('filtered-data-store', 'children'),
+        Input('grid-previous', 'n_clicks'),
+        Input('grid-next', 'n_clicks'),
+    ],
+    [
+        State('grid-page', 'data'),
+    ],
+)
+def update_molecule_grid(filtered, previous_clicks, next_clicks, page):
+
+    filtered_data = read_data_store(filtered)
+    n_pages = max(1, -(-len(filtered_data) // GRID_PAGE_SIZE))
+
+    # a new filtered set starts from the first page
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'grid-previous.n_clicks' in triggered:
+        page = max(page - 1, 0)
+    elif 'grid-next.n_clicks' in triggered:
+        page = min(page + 1, n_pages - 1)
+    else:
+        page = 0
+
+    # only the visible page is depicted, by the browser requesting /depict for each image
+    smiles = filtered_data['smiles'].iloc[page * GRID_PAGE_SIZE:(page + 1) * GRID_PAGE_SIZE]
+    images = [
+        html.Img(
+            src='/depict/svg?' + urllib.parse.urlencode({'smiles': s}),
+            title=s,
+            className='molecule-img',
+        )
+        for s in smiles
+    ]
+
+    return [images, f'page {page + 1} of {n_pages}', page]
+
+
+@server.route('/depict/<image_format>')
+def serve_depiction(image_format):
+
+    smiles = flask.request.args.get('smiles', '')
+    if image_format not in MIMETYPES:
+        flask.abort(404)
+    if not smiles.strip():
+        # an empty SMILES parses to an empty molecule, which must not be served as a blank image
+        flask.abort(400)
+
+    try:
+        image = depict(smiles, image_format)
+    except ValueError:
+        flask.abort(400)
+
+    response = flask.Response(image, mimetype=MIMETYPES[image_format])
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+
 if __name__ == '__main__':
     app.run_server(debug=False)
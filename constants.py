@@ -24,3 +24,11 @@ reaction_classes = {
     'Reductive Amination': 'reductive-amination',
     'MIDA Deprotection': 'mida-deprotection',
 }
+
+# available fingerprint types
+fingerprint_types = {
+    'Morgan': 'morgan',
+    'Feature Morgan': 'featmorgan',
+    'Atom Pair': 'atompair',
+    'RDKit': 'rdkit',
+}
@@ -0,0 +1,54 @@
+from functools import lru_cache
+
+from rdkit import Chem
+from rdkit.Chem.Draw import rdMolDraw2D
+
+
+##############
+# DEPICTIONS #
+##############
+
+DEPICTION_SIZE = 150
+CACHE_SIZE = 4096
+
+MIMETYPES = {
+    'svg': 'image/svg+xml',
+    'png': 'image/png',
+}
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def canonical_smiles(smiles):
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        raise ValueError(f'Invalid SMILES: {smiles}')
+    return Chem.MolToSmiles(mol)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _draw(canonical, image_format, size):
+    mol = Chem.MolFromSmiles(canonical)
+
+    if image_format == 'svg':
+        drawer = rdMolDraw2D.MolDraw2DSVG(size, size)
+    else:
+        drawer = rdMolDraw2D.MolDraw2DCairo(size, size)
+
+    drawer.drawOptions().clearBackground = False
+    rdMolDraw2D.PrepareAndDrawMolecule(drawer, mol)
+    drawer.FinishDrawing()
+
+    image = drawer.GetDrawingText()
+    return image.encode('utf-8') if isinstance(image, str) else image
+
+
+def depict(smiles, image_format='svg', size=DEPICTION_SIZE):
+    '''
+    Return a 2D depiction of smiles as SVG or PNG bytes.
+
+    Depictions are kept in a bounded LRU cache keyed by canonical SMILES, so the same
+    molecule written differently is only drawn once.
+    '''
+    if image_format not in MIMETYPES:
+        raise ValueError(f'Unknown image format: {image_format}')
+    return _draw(canonical_smiles(smiles), image_format, size)
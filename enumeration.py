@@ -0,0 +1,305 @@
+'''
+Virtual-product enumeration from building blocks and the reaction classes in preprocess.py.
+
+Compatible building blocks are combined through each reaction template. The combinatorial
+size is reported before anything is generated, and products are produced lazily in parallel
+chunks and streamed straight to a (gzip-compressed) CSV, so the product space is never held
+in memory.
+
+    python enumeration.py library.parquet products.csv.gz --reactions suzuki-miyaura --jobs 4
+'''
+import argparse
+import csv
+import gzip
+import multiprocessing
+import operator
+import random
+from collections import deque
+from functools import lru_cache, reduce
+
+import pandas as pd
+
+from rdkit import Chem, RDLogger
+from rdkit.Chem import AllChem
+
+from constants import reaction_classes
+from library import is_library_file, read_library
+from preprocess import reactant_smarts
+
+
+######################
+# REACTION TEMPLATES #
+######################
+
+# product side of each reaction class, mapped onto the atoms of preprocess.reactant_smarts
+product_smarts = {
+    'suzuki-miyaura': '[#6:1]-[#6:2]',
+    'buchwald-hartwig': '[c:1]-[N:2]',
+    'schotten-baumann-amide': '[C:1]-[N:2]',
+    'reductive-amination': '[#6:4]-[C:1]-[N:3]-[C:5]',
+    'mida-deprotection': '[#6:1]B(O)O',
+}
+
+CHUNK_SIZE = 10000
+
+
+@lru_cache(maxsize=None)
+def reaction(reaction_class):
+    smarts = '.'.join(reactant_smarts[reaction_class]) + '>>' + product_smarts[reaction_class]
+    return AllChem.ReactionFromSmarts(smarts)
+
+
+def library_size(pools):
+    return reduce(operator.mul, (len(pool) for pool in pools), 1)
+
+
+def _combination(pools, index):
+    '''Decode a flat index into one building block per pool (mixed radix, last pool fastest).'''
+    combination = []
+    for pool in reversed(pools):
+        index, i = divmod(index, len(pool))
+        combination.append(i)
+    return combination[::-1]
+
+
+###########
+# WORKERS #
+###########
+
+MATCH_CHUNK_SIZE = 2000
+
+# per-worker state: the shared pools proxy, and the pools (with parsed mols) already fetched from it
+# by reaction class, along with the version they were published under
+_worker = {}
+
+
+def _init_worker(shared_pools):
+    RDLogger.DisableLog('rdApp.*')
+    _worker['shared_pools'] = shared_pools
+    _worker['pools'] = {}
+
+
+def _worker_pools(reaction_class, version):
+    '''
+    Fetch the pools of reaction_class once per worker and version and parse them, rather
+    than sending them with every chunk.
+    '''
+    cached = _worker['pools'].get(reaction_class)
+    if cached is None or cached[0] != version:
+        published, pools = _worker['shared_pools'][reaction_class]
+        mols = [[Chem.MolFromSmiles(s) for s in pool] for pool in pools]
+        cached = _worker['pools'][reaction_class] = (published, pools, mols)
+    return cached[1:]
+
+
+class Workers:
+    '''
+    Worker processes shared by reactant-pool building and enumeration.
+
+    Reactant pools are published once through a manager dict, from which each worker
+    fetches and parses them on its first chunk of a reaction class. Every publication gets
+    a new version, so workers never reuse pools published for an earlier run.
+    '''
+
+    def __init__(self, n_jobs=None):
+        self.n_jobs = n_jobs or multiprocessing.cpu_count()
+        self._version = 0
+
+    def __enter__(self):
+        self._manager = multiprocessing.Manager()
+        self.shared_pools = self._manager.dict()
+        self._pool = multiprocessing.Pool(self.n_jobs, _init_worker, (self.shared_pools,))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._pool.terminate()
+        self._pool.join()
+        self._manager.shutdown()
+
+    def publish_pools(self, reaction_class, pools):
+        '''Publish the pools of reaction_class to the workers, returning the version that tasks must refer to.'''
+        self._version += 1
+        self.shared_pools[reaction_class] = (self._version, pools)
+        return self._version
+
+    def imap(self, func, tasks):
+        '''
+        Like Pool.imap, but with at most 2 * n_jobs tasks in flight, so neither queued tasks
+        nor finished results pile up in memory when the consumer is slower than the workers.
+        '''
+        in_flight = deque()
+        for task in tasks:
+            if len(in_flight) >= 2 * self.n_jobs:
+                yield in_flight.popleft().get()
+            in_flight.append(self._pool.apply_async(func, (task,)))
+        while in_flight:
+            yield in_flight.popleft().get()
+
+
+##################
+# REACTANT POOLS #
+##################
+
+def _match_chunk(task):
+    '''Return one list of the SMILES in the chunk matching each reactant template of the reaction class.'''
+    reaction_class, smiles = task
+    rxn = reaction(reaction_class)
+    templates = [rxn.GetReactantTemplate(i) for i in range(rxn.GetNumReactantTemplates())]
+
+    pools = [[] for _ in templates]
+    for s in smiles:
+        mol = Chem.MolFromSmiles(s)
+        if mol is None:
+            continue
+        for pool, template in zip(pools, templates):
+            if mol.HasSubstructMatch(template):
+                pool.append(s)
+    return pools
+
+
+def reactant_pools(workers, building_blocks, reaction_class, chunk_size=MATCH_CHUNK_SIZE):
+    '''
+    Return one list of building-block SMILES per reactant template of reaction_class.
+
+    When building_blocks has the reaction-class count column of a preprocessed library, only
+    molecules with a non-zero count are matched; matching is split across the workers.
+    '''
+    if reaction_class in building_blocks.columns:
+        building_blocks = building_blocks[building_blocks[reaction_class] > 0]
+    smiles = list(dict.fromkeys(building_blocks['smiles']))
+
+    chunks = ((reaction_class, smiles[i:i + chunk_size]) for i in range(0, len(smiles), chunk_size))
+    pools = [[] for _ in range(reaction(reaction_class).GetNumReactantTemplates())]
+    for chunk_pools in workers.imap(_match_chunk, chunks):
+        for pool, matches in zip(pools, chunk_pools):
+            pool.extend(matches)
+    return pools
+
+
+def reaction_pools(workers, building_blocks, reactions):
+    '''Return {reaction class: reactant pools} for the selected reaction classes.'''
+    return {reaction_class: reactant_pools(workers, building_blocks, reaction_class) for reaction_class in reactions}
+
+
+###############
+# ENUMERATION #
+###############
+
+def _enumerate_chunk(task):
+    '''Run the reaction on each combination in the chunk, returning [(product, reactants, class)].'''
+    reaction_class, version, indices = task
+    pools, mols = _worker_pools(reaction_class, version)
+    rxn = reaction(reaction_class)
+
+    rows = []
+    for index in indices:
+        combination = _combination(pools, index)
+        reactants = [pool_mols[i] for pool_mols, i in zip(mols, combination)]
+
+        products = set()
+        for product_set in rxn.RunReactants(reactants):
+            product = product_set[0]
+            try:
+                Chem.SanitizeMol(product)
+            except (ValueError, RuntimeError):
+                continue
+            products.add(Chem.MolToSmiles(product))
+
+        names = '.'.join(pool[i] for pool, i in zip(pools, combination))
+        rows.extend((product, names, reaction_class) for product in sorted(products))
+    return rows
+
+
+def _chunks(size, chunk_size, n_samples, seed):
+    '''Yield chunks of flat combination indices, either all of them or a random sample.'''
+    if n_samples is None or n_samples >= size:
+        for start in range(0, size, chunk_size):
+            yield range(start, min(start + chunk_size, size))
+    else:
+        # sampling from a range never materialises the full index space
+        sample = sorted(random.Random(seed).sample(range(size), n_samples))
+        for start in range(0, n_samples, chunk_size):
+            yield sample[start:start + chunk_size]
+
+
+def enumerate_products(workers, pools, sink, chunk_size=CHUNK_SIZE, n_samples=None, seed=None):
+    '''
+    Enumerate the products of each reaction class in pools ({reaction class: reactant pools},
+    as returned by reaction_pools) and stream them to sink as CSV rows.
+
+    sink is a path, gzip-compressed when it ends in .gz, or a writable text file object.
+    With n_samples, only that many combinations are drawn at random per reaction class.
+    Returns the number of products written.
+    '''
+    if isinstance(sink, str):
+        with (gzip.open(sink, 'wt', newline='') if sink.endswith('.gz') else open(sink, 'w', newline='')) as f:
+            return enumerate_products(workers, pools, f, chunk_size, n_samples, seed)
+
+    writer = csv.writer(sink)
+    writer.writerow(['smiles', 'reactants', 'reaction'])
+
+    n_written = 0
+    for reaction_class, class_pools in pools.items():
+        size = library_size(class_pools)
+        if size == 0:
+            continue
+
+        version = workers.publish_pools(reaction_class, class_pools)
+        tasks = ((reaction_class, version, chunk) for chunk in _chunks(size, chunk_size, n_samples, seed))
+        for rows in workers.imap(_enumerate_chunk, tasks):
+            writer.writerows(rows)
+            n_written += len(rows)
+
+    return n_written
+
+
+def read_building_blocks(path):
+    '''
+    Read building blocks from an exported library, keeping its reaction-class count columns,
+    or from a .csv/excel file of SMILES. Returns a DataFrame with a smiles column.
+    '''
+    if is_library_file(path):
+        return read_library(path)
+    if 'xls' in path:
+        df = pd.read_excel(path)
+    else:
+        df = pd.read_csv(path)
+    return pd.DataFrame({'smiles': df.iloc[:, 0].astype(str)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='exported library, or .csv/excel file of building-block SMILES')
+    parser.add_argument('output', help='product CSV, gzip-compressed if it ends in .gz')
+    parser.add_argument('--reactions', nargs='+', default=list(product_smarts),
+                        choices=list(product_smarts), help='reaction classes to enumerate')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes (default: all CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='combinations per worker task')
+    parser.add_argument('--sample', type=int, default=None,
+                        help='enumerate this many random combinations per reaction class, for previews')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--dry-run', action='store_true', help='only report the combinatorial sizes')
+    args = parser.parse_args()
+
+    RDLogger.DisableLog('rdApp.*')
+    building_blocks = read_building_blocks(args.input)
+
+    with Workers(args.jobs) as workers:
+        pools = reaction_pools(workers, building_blocks, args.reactions)
+        sizes = {reaction_class: library_size(p) for reaction_class, p in pools.items()}
+
+        names = {value: label for label, value in reaction_classes.items()}
+        for reaction_class, size in sizes.items():
+            pool_sizes = ' x '.join(str(len(pool)) for pool in pools[reaction_class])
+            print(f'{names[reaction_class]:<24}{pool_sizes:>20} = {size:,} combinations', flush=True)
+        print(f'{"total":<24}{"":>20} = {sum(sizes.values()):,} combinations', flush=True)
+
+        if args.dry_run:
+            return
+
+        n_written = enumerate_products(workers, pools, args.output, args.chunk_size, args.sample, args.seed)
+    print(f'{n_written:,} products written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import numpy as np
+
+from registry import Registry
+
+
+####################
+# GROUP HIT COUNTS #
+####################
+
+MAX_DATASETS = 4
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _pack(mask):
+    return np.packbits(np.asarray(mask, dtype=bool))
+
+
+def _exactly_once(masks, like):
+    '''Packed mask of the rows set in exactly one of masks.'''
+    once, twice = np.zeros_like(like), np.zeros_like(like)
+    for mask in masks:
+        twice |= once & mask
+        once |= mask
+    return once & ~twice
+
+
+class GroupIndex:
+    '''
+    Per-group presence bitmasks of a preprocessed dataset.
+
+    Each reaction class or functional group column becomes one packed bit per molecule,
+    so the effect of toggling every option can be counted in a single popcount pass
+    over the (n_groups, n_bytes) matrix instead of running the filter once per option.
+    '''
+
+    def __init__(self, data, groups):
+        self.groups = list(groups)
+        self._rows = {group: i for i, group in enumerate(self.groups)}
+
+        # duplicate SMILES are only counted once, as in the filtered output
+        self._unique = _pack(~data['smiles'].duplicated().values)
+        self._presence = np.packbits(data[self.groups].values.T > 0, axis=1)
+        self._molwt = data['molwt'].values
+        self._logp = data['logp'].values
+
+    def _union(self, groups):
+        union = np.zeros_like(self._unique)
+        for group in groups:
+            union |= self._presence[self._rows[group]]
+        return union
+
+    def counts(self, include, exclude, molwt_cutoff, logp_cutoff):
+        '''
+        Return ({group: n}, {group: n}) for the include and exclude selectors.
+
+        For an option that is not selected, n is how many molecules selecting it would add
+        (include) or remove (exclude); for a selected option, how many deselecting it would
+        remove (include) or add back (exclude).
+        '''
+        base = self._unique & _pack((self._molwt < molwt_cutoff) & (self._logp < logp_cutoff))
+        included = self._union(include)
+        excluded = self._union(exclude)
+        filtered = included & ~excluded & base
+
+        only_included = _exactly_once([self._presence[self._rows[g]] for g in include], base)
+        only_excluded = _exactly_once([self._presence[self._rows[g]] for g in exclude], base)
+
+        masks = {
+            ('include', False): ~included & ~excluded & base,
+            ('include', True): filtered & only_included,
+            ('exclude', False): filtered,
+            ('exclude', True): included & base & only_excluded,
+        }
+
+        # one row per (selector, group), each ANDed with the mask for its selection state
+        keys = [('include', g) for g in self.groups] + [('exclude', g) for g in self.groups]
+        selected = {'include': set(include), 'exclude': set(exclude)}
+        mask_matrix = np.stack([masks[(selector, g in selected[selector])] for selector, g in keys])
+        presence = np.concatenate([self._presence, self._presence])
+
+        hits = POPCOUNT[presence & mask_matrix].sum(axis=1, dtype=np.int64)
+
+        n = len(self.groups)
+        return dict(zip(self.groups, hits[:n].tolist())), dict(zip(self.groups, hits[n:].tolist()))
+
+
+_indexes = Registry(MAX_DATASETS)
+
+
+def get_group_index(key, data_loader, groups):
+    '''
+    Return the GroupIndex for the dataset identified by key, building it from
+    data_loader() on a miss. Only the MAX_DATASETS most recently used datasets are kept.
+    '''
+    return _indexes.get_or_build(key, lambda: GroupIndex(data_loader(), groups))
@@ -0,0 +1,97 @@
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+
+#################################
+# PREPROCESSED LIBRARY FILE I/O #
+#################################
+
+SCHEMA_VERSION = '2'
+SCHEMA_VERSION_KEY = b'db-builder.schema-version'
+
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+ARROW_EXTENSIONS = ('.arrow', '.feather', '.ipc')
+LIBRARY_EXTENSIONS = PARQUET_EXTENSIONS + ARROW_EXTENSIONS
+
+
+def is_library_file(file_name):
+    return file_name.lower().endswith(LIBRARY_EXTENSIONS)
+
+
+def _fp_columns(columns):
+    return [c for c in columns if c.startswith('fp-')]
+
+
+def to_table(df):
+    '''Convert a preprocessed DataFrame to an Arrow table, storing fingerprints as packed bytes.'''
+    df = df.drop(columns=['mol'], errors='ignore').copy()
+    fp_columns = _fp_columns(df.columns)
+    for column in fp_columns:
+        df[column] = df[column].apply(bytes.fromhex)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for column in fp_columns:
+        i = table.schema.get_field_index(column)
+        table = table.set_column(i, column, table.column(i).cast(pa.binary()))
+
+    return table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        SCHEMA_VERSION_KEY: SCHEMA_VERSION.encode(),
+    })
+
+
+def from_table(table):
+    '''Convert an Arrow table written by to_table back into a preprocessed DataFrame.'''
+    metadata = table.schema.metadata or {}
+    version = metadata.get(SCHEMA_VERSION_KEY, b'').decode()
+    if version != SCHEMA_VERSION:
+        raise ValueError(f'Unsupported library schema version: {version or "missing"}')
+
+    df = table.to_pandas()
+    for column in _fp_columns(df.columns):
+        df[column] = df[column].apply(bytes.hex)
+
+    return df
+
+
+def write_library(df, sink, file_format='parquet'):
+    '''
+    Write a preprocessed DataFrame to sink (a path or writable file object)
+    as a Parquet or Arrow IPC (Feather v2) file.
+    '''
+    table = to_table(df)
+    if file_format == 'parquet':
+        pq.write_table(table, sink, compression='zstd')
+    elif file_format == 'arrow':
+        with ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f'Unknown library format: {file_format}')
+
+
+def library_to_bytes(df, file_format='parquet'):
+    sink = pa.BufferOutputStream()
+    write_library(df, sink, file_format)
+    return sink.getvalue().to_pybytes()
+
+
+def read_library(source, file_name=None):
+    '''
+    Read a preprocessed library written by write_library, skipping preprocess().
+
+    source may be a path, which is memory-mapped, or the raw file contents as bytes.
+    The format is taken from file_name (or the path) and defaults to Parquet.
+    '''
+    if isinstance(source, (bytes, bytearray)):
+        buffer = pa.BufferReader(source)
+    else:
+        file_name = file_name or str(source)
+        buffer = pa.memory_map(str(source))
+
+    if file_name is not None and file_name.lower().endswith(ARROW_EXTENSIONS):
+        table = ipc.open_file(buffer).read_all()
+    else:
+        table = pq.read_table(buffer)
+
+    return from_table(table)
@@ -0,0 +1,405 @@
+'''
+Concurrent-session load test for the Dash callbacks in app.py.
+
+Starts the app on localhost (or targets an already running one with --url), reads its
+callbacks from _dash-dependencies, then simulates N sessions that each upload a library,
+toggle the group selectors, drag the sliders and export, posting straight to Dash's
+_dash-update-component endpoint.
+Reports latency percentiles, throughput and peak server RSS per callback.
+
+    python loadtest.py --sessions 8 --molecules 500
+'''
+import argparse
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+from constants import functional_groups, reaction_classes
+
+SAMPLE_SMILES = [
+    'OB(O)c1ccccc1', 'OB(O)c1ccc(F)cc1', 'Brc1ccccc1', 'Brc1ccc(C(F)(F)F)cc1', 'Clc1ccncc1',
+    'Nc1ccccc1', 'NCc1ccccc1', 'CCNCC', 'OC(=O)c1ccccc1', 'OC(=O)CCc1ccccc1',
+    'O=Cc1ccccc1', 'CC(=O)c1ccccc1', 'CCOc1ccccc1', 'CN(C)c1ccccc1', 'N#Cc1ccccc1',
+    'O=[N+]([O-])c1ccccc1', 'Oc1ccccc1', 'CCS', 'CSc1ccccc1', 'OS(=O)(=O)c1ccccc1',
+]
+
+
+#############
+# CALLBACKS #
+#############
+
+def get_json(url, timeout):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def _prop(spec):
+    component_id, component_property = spec.rsplit('.', 1)
+    return component_id, component_property
+
+
+class Callback:
+    '''A server-side callback as listed by Dash's _dash-dependencies endpoint.'''
+
+    def __init__(self, dependency):
+        self.output = dependency['output']
+        self.multi = self.output.startswith('..')
+        if self.multi:
+            self.outputs = [_prop(spec) for spec in self.output[2:-2].split('...')]
+        else:
+            self.outputs = [_prop(self.output)]
+        self.inputs = [(d['id'], d['property']) for d in dependency['inputs']]
+        self.state = [(d['id'], d['property']) for d in dependency['state']]
+
+        # callbacks are reported by their first output, as Dash does not expose function names
+        first = '.'.join(self.outputs[0])
+        self.name = first if len(self.outputs) == 1 else f'{first} (+{len(self.outputs) - 1})'
+
+    def payload(self, values, changed):
+        '''Build the _dash-update-component request body, given the current property values.'''
+        outputs = [{'id': i, 'property': p} for i, p in self.outputs]
+
+        def props(pairs):
+            return [{'id': i, 'property': p, 'value': values.get((i, p))} for i, p in pairs]
+
+        return {
+            'output': self.output,
+            'outputs': outputs if self.multi else outputs[0],
+            'inputs': props(self.inputs),
+            'state': props(self.state),
+            'changedPropIds': [f'{i}.{p}' for i, p in changed],
+        }
+
+    def response(self, body):
+        '''Map a _dash-update-component response back onto {(component id, property): value}.'''
+        response = body['response']
+        if 'props' in response:
+            response = {self.outputs[0][0]: response['props']}
+        return {(i, p): response[i][p] for i, p in self.outputs if p in response.get(i, {})}
+
+
+def get_callbacks(url, timeout):
+    '''Read the server-side callbacks of the running app from _dash-dependencies.'''
+    dependencies = get_json(url + '/_dash-dependencies', timeout)
+    return [Callback(d) for d in dependencies if not d.get('clientside_function')]
+
+
+def layout_values(node, values=None):
+    '''Collect the initial {(component id, property): value} of every component in a _dash-layout tree.'''
+    values = {} if values is None else values
+    if isinstance(node, list):
+        for child in node:
+            layout_values(child, values)
+    elif isinstance(node, dict) and 'props' in node:
+        props = node['props']
+        for name, value in props.items():
+            if 'id' in props:
+                values[(props['id'], name)] = value
+            layout_values(value, values)
+    return values
+
+
+###########
+# METRICS #
+###########
+
+class RSSSampler(threading.Thread):
+    '''Sample the resident set size of a process at a fixed interval.'''
+
+    def __init__(self, pid, interval=0.01):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def rss(self):
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process(self.pid).memory_info().rss
+
+    def run(self):
+        while not self._stop_event.is_set():
+            rss = self.rss()
+            if rss is not None:
+                self.samples.append((time.perf_counter(), rss))
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def peak(self, start, end):
+        window = [rss for t, rss in self.samples if start <= t <= end]
+        return max(window) if window else None
+
+
+def percentile(values, q):
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def report(timings, sampler, wall_time):
+    width = max([len(name) for name in timings] + [len('callback')]) + 2
+    header = f'{"callback":<{width}}{"calls":>7}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}' \
+             f'{"calls/s":>10}{"peak RSS MB":>13}{"errors":>8}'
+    print(header)
+    print('-' * len(header))
+
+    for name, calls in timings.items():
+
+        latencies = [1000 * (end - start) for start, end, ok in calls if ok]
+        errors = sum(not ok for _, _, ok in calls)
+        peaks = [sampler.peak(start, end) for start, end, _ in calls] if sampler else []
+        peaks = [p for p in peaks if p is not None]
+        peak = f'{max(peaks) / 2 ** 20:.1f}' if peaks else '-'
+
+        if latencies:
+            p50, p90, p99 = (percentile(latencies, q) for q in (50, 90, 99))
+            stats = f'{p50:>10.1f}{p90:>10.1f}{p99:>10.1f}{max(latencies):>10.1f}'
+        else:
+            stats = f'{"-":>10}' * 4
+
+        print(f'{name:<{width}}{len(calls):>7}{stats}{len(calls) / wall_time:>10.2f}{peak:>13}{errors:>8}')
+
+    total = sum(len(calls) for calls in timings.values())
+    print(f'\n{total} callbacks in {wall_time:.1f} s ({total / wall_time:.2f} callbacks/s)')
+
+
+############
+# SESSIONS #
+############
+
+class Session:
+    '''
+    One simulated user, keeping its own copy of the component properties it has seen.
+
+    Like the Dash renderer, changing a property runs every callback that takes it as an
+    input, then the callbacks that depend on their outputs, until nothing is left to update.
+    '''
+
+    def __init__(self, url, callbacks, upload_contents, upload_name, timings, lock, seed, timeout):
+        self.url = url.rstrip('/')
+        self.callbacks = callbacks
+        self.upload = ([upload_contents], [upload_name])
+        self.timings = timings
+        self.lock = lock
+        self.random = random.Random(seed)
+        self.timeout = timeout
+        self.values = {}
+
+    def record(self, name, start, end, ok):
+        with self.lock:
+            self.timings[name].append((start, end, ok))
+
+    def call(self, callback, changed):
+        body = json.dumps(callback.payload(self.values, changed)).encode('utf-8')
+        request = urllib.request.Request(
+            self.url + '/_dash-update-component', data=body, headers={'Content-Type': 'application/json'}
+        )
+
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                result = response.read()
+            ok = True
+        except (urllib.error.URLError, OSError) as e:
+            print(f'{callback.name} failed: {e}', file=sys.stderr)
+            result, ok = None, False
+        self.record(callback.name, start, time.perf_counter(), ok)
+
+        if not result:
+            return {}
+        updated = callback.response(json.loads(result))
+        self.values.update(updated)
+        return updated
+
+    def set(self, changes):
+        '''Set component properties and run every callback that (transitively) depends on them.'''
+        self.values.update(changes)
+        changed = set(changes)
+        pending = [c for c in self.callbacks if changed & set(c.inputs)]
+
+        while pending:
+            # wait for callbacks whose outputs feed another pending callback
+            outputs = {o for c in pending for o in c.outputs}
+            ready = [c for c in pending if not outputs & (set(c.inputs) - set(c.outputs))] or pending[:1]
+
+            updated = set()
+            for callback in ready:
+                updated |= set(self.call(callback, [p for p in callback.inputs if p in changed]))
+            changed |= updated
+
+            pending = [c for c in pending if c not in ready]
+            pending += [c for c in self.callbacks if updated & set(c.inputs) and c not in pending]
+
+    def toggle(self, component, options):
+        selected = self.values[(component, 'value')]
+        option = self.random.choice(options)
+        if option in selected:
+            selected = [o for o in selected if o != option]
+        else:
+            selected = selected + [option]
+        self.set({(component, 'value'): selected})
+
+    def drag(self, slider, start, stop, steps):
+        for n in range(1, steps + 1):
+            self.set({(slider, 'value'): round(start + (stop - start) * n / steps, 1)})
+
+    def export(self):
+        '''Download every export link that the server builds on request.'''
+        for (component_id, prop), href in list(self.values.items()):
+            if prop != 'href' or not isinstance(href, str) or not href.startswith('/'):
+                continue
+
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(self.url + href, timeout=self.timeout) as response:
+                    response.read()
+                ok = True
+            except (urllib.error.URLError, OSError) as e:
+                print(f'GET {href} failed: {e}', file=sys.stderr)
+                ok = False
+            self.record('GET ' + href.split('?')[0], start, time.perf_counter(), ok)
+
+    def run(self, iterations):
+        # each session loads its own layout, as a browser would
+        self.values = layout_values(get_json(self.url + '/_dash-layout', self.timeout))
+
+        contents, filename = self.upload
+        self.set({('upload-data', 'contents'): contents, ('upload-data', 'filename'): filename})
+
+        rxns = list(reaction_classes.values())
+        fgroups = list(functional_groups.values())
+
+        for _ in range(iterations):
+            self.toggle('rxn-class-select', rxns)
+            self.toggle('rxn-class-select', rxns)
+            self.toggle('fgroup-class-select', fgroups)
+            self.toggle('fgroup-class-exclude', fgroups)
+
+            self.drag('slider-molwt', 1000, self.random.uniform(200, 600), 5)
+            self.drag('slider-logp', 20, self.random.uniform(2, 8), 5)
+            self.drag('slider-molwt', self.values[('slider-molwt', 'value')], 1000, 2)
+            self.drag('slider-logp', self.values[('slider-logp', 'value')], 20, 2)
+
+            self.export()
+
+
+##########
+# SERVER #
+##########
+
+def start_server(port):
+    '''Start app.py on localhost:port in a subprocess and wait until it responds.'''
+    code = f'import app; app.app.run_server(host="127.0.0.1", port={port}, debug=False, threaded=True)'
+    process = subprocess.Popen(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('app.py exited before it started serving')
+        try:
+            urllib.request.urlopen(url, timeout=1).close()
+            return process, url
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError(f'app.py did not start serving on {url}')
+
+
+def read_upload(path, n_molecules, seed):
+    '''Return the (data URI, file name) uploaded by every session.'''
+    if path is not None:
+        with open(path, 'rb') as f:
+            contents = f.read()
+        name = os.path.basename(path)
+    else:
+        rng = random.Random(seed)
+        smiles = [rng.choice(SAMPLE_SMILES) for _ in range(n_molecules)]
+        contents = ('smiles\n' + '\n'.join(smiles) + '\n').encode('utf-8')
+        name = 'loadtest.csv'
+
+    return 'data:application/octet-stream;base64,' + base64.b64encode(contents).decode('ascii'), name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=4, help='number of concurrent sessions')
+    parser.add_argument('--iterations', type=int, default=3, help='filtering rounds per session')
+    parser.add_argument('--input', default=None, help='.csv, excel or library file to upload')
+    parser.add_argument('--molecules', type=int, default=200,
+                        help='size of the generated upload when --input is not given')
+    parser.add_argument('--url', default=None, help='target a running app instead of starting one')
+    parser.add_argument('--port', type=int, default=8051, help='port to start the app on')
+    parser.add_argument('--timeout', type=float, default=300, help='per-request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    upload_contents, upload_name = read_upload(args.input, args.molecules, args.seed)
+
+    process, sampler = None, None
+    if args.url is None:
+        process, url = start_server(args.port)
+        sampler = RSSSampler(process.pid)
+        sampler.start()
+    else:
+        url = args.url
+
+    timings = defaultdict(list)
+    lock = threading.Lock()
+
+    try:
+        callbacks = get_callbacks(url, args.timeout)
+        sessions = [
+            Session(url, callbacks, upload_contents, upload_name, timings, lock, args.seed + n, args.timeout)
+            for n in range(args.sessions)
+        ]
+        threads = [threading.Thread(target=session.run, args=(args.iterations,)) for session in sessions]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_time = time.perf_counter() - start
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print(f'{args.sessions} sessions x {args.iterations} iterations against {url}\n')
+    report(timings, sampler, wall_time)
+
+
+if __name__ == '__main__':
+    main()
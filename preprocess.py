@@ -1,8 +1,69 @@
+from functools import lru_cache
+
+import numpy as np
+
 from rdkit.Chem import Fragments
-from rdkit import Chem, DataStructs
-from rdkit.Chem import Descriptors, rdMolDescriptors
+from rdkit import Chem
+from rdkit.Chem import Descriptors, rdFingerprintGenerator
+
+from constants import fingerprint_types
+
+
+################
+# FINGERPRINTS #
+################
+
+FP_RADIUS = 2
+FP_SIZE = 512
+FP_TYPES = tuple(fingerprint_types.values())
+
+
+def fp_column(fp_type):
+    return f'fp-{fp_type}'
+
+
+@lru_cache(maxsize=None)
+def fingerprint_generator(fp_type, radius=FP_RADIUS, fp_size=FP_SIZE):
+    '''Return a reusable RDKit fingerprint generator for fp_type.'''
+    if fp_size % 8:
+        raise ValueError(f'Fingerprint size must be a multiple of 8, got {fp_size}')
+
+    if fp_type == 'morgan':
+        return rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=fp_size)
+    if fp_type == 'featmorgan':
+        return rdFingerprintGenerator.GetMorganGenerator(
+            radius=radius, fpSize=fp_size,
+            atomInvariantsGenerator=rdFingerprintGenerator.GetMorganFeatureAtomInvGen(),
+        )
+    if fp_type == 'atompair':
+        return rdFingerprintGenerator.GetAtomPairGenerator(fpSize=fp_size)
+    if fp_type == 'rdkit':
+        return rdFingerprintGenerator.GetRDKitFPGenerator(fpSize=fp_size)
+    raise ValueError(f'Unknown fingerprint type: {fp_type}')
+
+
+def fingerprints(mols, fp_type='morgan', radius=FP_RADIUS, fp_size=FP_SIZE):
+    '''Fingerprint mols with a single generator, returning a packed (n, fp_size / 8) uint8 matrix.'''
+    generator = fingerprint_generator(fp_type, radius, fp_size)
+
+    bits = np.zeros((len(mols), fp_size), dtype=np.uint8)
+    for i, mol in enumerate(mols):
+        if mol is not None:
+            bits[i] = generator.GetFingerprintAsNumPy(mol)
+
+    return np.packbits(bits, axis=1)
 
-from scipy.spatial import distance
+
+def fps_to_hex(packed):
+    '''Encode each row of a packed fingerprint matrix as a hex string, for storage in a DataFrame.'''
+    return [row.tobytes().hex() for row in packed]
+
+
+def hex_to_fps(fps):
+    '''Decode hex fingerprint strings into a packed (n, n_bytes) uint8 matrix.'''
+    fps = list(fps)
+    n_bytes = len(fps[0]) // 2 if fps else 0
+    return np.frombuffer(bytes.fromhex(''.join(fps)), dtype=np.uint8).reshape(len(fps), n_bytes)
 
 
 #####################
@@ -13,10 +74,6 @@ def get_mol(smiles):
     return Chem.MolFromSmiles(smiles)
 
 
-def fp(mol):
-    return list(rdMolDescriptors.GetMorganFingerprintAsBitVect(mol, 2, nBits=512))
-
-
 def logp(mol):
     return round(Descriptors.MolLogP(mol), 4)
 
@@ -104,98 +161,65 @@ def Br(mol):
 # REACTION CLASSES #
 ####################
 
-def suzuki(mol):
-    grps = ['[#6;H0;D3:1]B([OH])[OH]', '[#6;H0;D3:2][Br,I,Cl]']
-
-    total = 0
-    for grp in grps:
-        patt = Chem.MolFromSmarts(grp)
-        total += len(mol.GetSubstructMatches(patt))
-    return total
-
-
-def buchwald_hartwig(mol):
-    grps = [
+# atom-mapped reactant templates of each reaction class, shared with enumeration.py
+reactant_smarts = {
+    'suzuki-miyaura': ['[#6;H0;D3:1]B([OH])[OH]', '[#6;H0;D3:2][Br,I,Cl]'],
+    'buchwald-hartwig': [
         '[Cl,Br,I][c;$(c1:[c,n]:[c,n]:[c,n]:[c,n]:[c,n]:1):1]',
         '[N;$(NC)&!$(N=*)&!$([N-])&!$(N#*)&!$([ND3])&!$([ND4])&!$'
         '(N[c,O])&!$(N[C,S]=[S,O,N]),H2&$(Nc1:[c,n]:[c,n]:[c,n]:[c,n]'
         ':[c,n]:1):2]'
-    ]
-
-    total = 0
-    for grp in grps:
-        patt = Chem.MolFromSmarts(grp)
-        total += len(mol.GetSubstructMatches(patt))
-    return total
-
-
-def schotten_baumann_amide(mol):
-    grps = [
+    ],
+    'schotten-baumann-amide': [
         '[C;$(C=O):1][OH1]',
         '[N;$(N[#6]);!$(N=*);!$([N-]);!$(N#*);!$([ND3]);!$([ND4]);!$(N[O,N]);!$(N[C,S]=[S,O,N]):2]'
-    ]
-
-    total = 0
-    for grp in grps:
-        patt = Chem.MolFromSmarts(grp)
-        total += len(mol.GetSubstructMatches(patt))
-    return total
-
-
-def reductive_amination(mol):
-    grps = [
+    ],
+    'reductive-amination': [
         '[#6:4]-[C;H1,$([CH0](-[#6])[#6]):1]=[OD1]',
         '[N;H2,$([NH1;D2](C)C);!$(N-[#6]=[*]):3]-[C:5]'
-    ]
+    ],
+    'mida-deprotection': ['[#6:1]B12OC(=O)C[N+](C)1CC(=O)O2'],
+}
 
+
+def count_reactant_matches(mol, reaction_class):
     total = 0
-    for grp in grps:
+    for grp in reactant_smarts[reaction_class]:
         patt = Chem.MolFromSmarts(grp)
         total += len(mol.GetSubstructMatches(patt))
     return total
 
 
-def mida_deprotection(mol):
-    grps = ['[#6:1]B12OC(=O)C[N+](C)1CC(=O)O2']
+def suzuki(mol):
+    return count_reactant_matches(mol, 'suzuki-miyaura')
 
-    total = 0
-    for grp in grps:
-        patt = Chem.MolFromSmarts(grp)
-        total += len(mol.GetSubstructMatches(patt))
-    return total
 
+def buchwald_hartwig(mol):
+    return count_reactant_matches(mol, 'buchwald-hartwig')
 
-####################
-# SIMILARITY CALCS #
-####################
 
-def calculate_pairwise_similarities(df):
+def schotten_baumann_amide(mol):
+    return count_reactant_matches(mol, 'schotten-baumann-amide')
 
-    def calc_tanimoto_similarity(fp1, fp2):
-        return DataStructs.TanimotoSimilarity(fp1, fp2)
 
-    n_molecules = len(df.smiles)
+def reductive_amination(mol):
+    return count_reactant_matches(mol, 'reductive-amination')
 
-    similarities = []
-    for i in range(n_molecules):
-        for j in range(n_molecules - i):
-            similarity = 1 - distance.jaccard(df.fp.iloc[i], df.fp.iloc[j])
-            similarities.append(similarity)
 
-    return similarities
+def mida_deprotection(mol):
+    return count_reactant_matches(mol, 'mida-deprotection')
 
 
 #################
 # PREPROCESSING #
 #################
 
-def preprocess(df_from_upload):
+def preprocess(df_from_upload, fp_types=FP_TYPES, fp_radius=FP_RADIUS, fp_size=FP_SIZE):
 
     df = df_from_upload
     df.columns = ['smiles']
 
     preprocess_functions_fgroups = {
-        'fp': fp,
         'logp': logp,
         'molwt': molwt,
         'NH2': NH2,
@@ -223,6 +247,9 @@ def preprocess(df_from_upload):
 
     df['mol'] = df.smiles.apply(get_mol)
 
+    for fp_type in fp_types:
+        df[fp_column(fp_type)] = fps_to_hex(fingerprints(df.mol.tolist(), fp_type, fp_radius, fp_size))
+
     for name, function in preprocess_functions_fgroups.items():
         df[name] = df.mol.apply(function)
 
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+
+
+############
+# REGISTRY #
+############
+
+class Registry:
+    '''
+    Thread-safe mapping that keeps only the max_size most recently used entries.
+
+    Entries missing from get_or_build are built outside the registry-wide lock, holding only
+    a lock for their key: concurrent requests for the same key wait for a single build, while
+    requests for other keys are not held up by it.
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        # callers hold self._lock
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return True, self._entries[key]
+        return False, None
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._lookup(key)
+        return value if found else default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_build(self, key, build):
+        '''Return the entry for key, building it with build() on a miss.'''
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                return value
+            key_lock = self._building.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # another thread may have built it while we waited
+            with self._lock:
+                found, value = self._lookup(key)
+            if found:
+                return value
+
+            try:
+                value = build()
+                self.set(key, value)
+            finally:
+                with self._lock:
+                    self._building.pop(key, None)
+            return value
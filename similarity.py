@@ -0,0 +1,164 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from registry import Registry
+
+
+####################
+# SIMILARITY CACHE #
+####################
+
+N_BINS = 100
+TILE_SIZE = 512
+MAX_TILES = 256
+MAX_DATASETS = 4
+MAX_SESSIONS = 64
+
+
+class SimilarityCache:
+    '''
+    Pairwise Tanimoto similarity histogram of a dataset, kept up to date as the selection changes.
+
+    The full similarity matrix is stored as square tiles of histogram bin indices. Tiles are
+    computed on first use and evicted least-recently-used once more than max_tiles are held,
+    so small datasets end up fully cached and large ones are recomputed tile by tile.
+    Incremental updates never compute a whole tile just to read a few rows from it.
+
+    Tiles are shared by every session using the dataset, while the last selection and its
+    histogram are kept per session (the max_sessions most recent). When a session's selection
+    changes, only the pairs involving added or removed rows are binned and its previous
+    histogram is adjusted, rather than recounting every pair.
+    '''
+
+    def __init__(self, fps, n_bins=N_BINS, tile_size=TILE_SIZE, max_tiles=MAX_TILES, max_sessions=MAX_SESSIONS):
+        self.n_bins = n_bins
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.max_sessions = max_sessions
+
+        self._fps = fps
+        self._n_set = np.unpackbits(fps, axis=1).sum(axis=1).astype(np.float32)
+        self._tiles = OrderedDict()
+
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._fps)
+
+    @property
+    def bin_edges(self):
+        return np.linspace(0, 1, self.n_bins + 1)
+
+    def _block(self, b):
+        return slice(b * self.tile_size, (b + 1) * self.tile_size)
+
+    def _bins(self, rows_i, rows_j):
+        '''Bin indices of the similarities between rows_i and rows_j (slices or index arrays).'''
+        bits_i = np.unpackbits(self._fps[rows_i], axis=1).astype(np.float32)
+        bits_j = np.unpackbits(self._fps[rows_j], axis=1).astype(np.float32)
+
+        intersection = bits_i @ bits_j.T
+        union = self._n_set[rows_i, None] + self._n_set[None, rows_j] - intersection
+        similarity = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+        return np.minimum(similarity * self.n_bins, self.n_bins - 1).astype(np.uint8)
+
+    def _tile(self, bi, bj):
+        '''Bin indices of block bi against block bj, with bi <= bj.'''
+        key = (bi, bj)
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+
+        tile = self._bins(self._block(bi), self._block(bj))
+        self._tiles[key] = tile
+        while len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return tile
+
+    def _pair_bins(self, ba, local_a, bb, local_b, fill_tiles):
+        '''
+        Bin indices of the local rows of block ba against the local rows of block bb.
+
+        Without fill_tiles, a tile that is not already cached is not computed in full: only
+        the requested rows are compared, which is much cheaper when few rows are needed.
+        '''
+        if ba > bb:
+            return self._pair_bins(bb, local_b, ba, local_a, fill_tiles).T
+        if fill_tiles or (ba, bb) in self._tiles:
+            return self._tile(ba, bb)[np.ix_(local_a, local_b)]
+        return self._bins(local_a + ba * self.tile_size, local_b + bb * self.tile_size)
+
+    def _split(self, rows):
+        '''Group sorted row indices by block, yielding (block, local indices).'''
+        blocks = rows // self.tile_size
+        for b in np.unique(blocks):
+            yield b, rows[blocks == b] - b * self.tile_size
+
+    def _bincount(self, bins):
+        return np.bincount(bins.ravel(), minlength=self.n_bins)
+
+    def cross_counts(self, rows_a, rows_b, fill_tiles=False):
+        '''Histogram of similarities between every row in rows_a and every row in rows_b (disjoint).'''
+        counts = np.zeros(self.n_bins, dtype=np.int64)
+        for ba, local_a in self._split(rows_a):
+            for bb, local_b in self._split(rows_b):
+                counts += self._bincount(self._pair_bins(ba, local_a, bb, local_b, fill_tiles))
+        return counts
+
+    def within_counts(self, rows, fill_tiles=True):
+        '''Histogram of similarities between every unique pair of rows.'''
+        counts = np.zeros(self.n_bins, dtype=np.int64)
+        blocks = list(self._split(rows))
+        for n, (ba, local_a) in enumerate(blocks):
+            bins = self._pair_bins(ba, local_a, ba, local_a, fill_tiles)
+            counts += self._bincount(bins[np.triu_indices(len(local_a), k=1)])
+            for bb, local_b in blocks[n + 1:]:
+                counts += self._bincount(self._pair_bins(ba, local_a, bb, local_b, fill_tiles))
+        return counts
+
+    def update(self, rows, session=None):
+        '''Move session's selection to rows and return the similarity histogram counts of the new selection.'''
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        with self._lock:
+            return self._update(rows, session)
+
+    def _update(self, rows, session):
+        if session in self._sessions:
+            self._sessions.move_to_end(session)
+            old, old_counts = self._sessions[session]
+        else:
+            old, old_counts = np.zeros(0, dtype=np.int64), np.zeros(self.n_bins, dtype=np.int64)
+
+        removed = np.setdiff1d(old, rows, assume_unique=True)
+        added = np.setdiff1d(rows, old, assume_unique=True)
+
+        if len(removed) + len(added) >= len(rows):
+            # the selection has changed enough that a recount is cheaper
+            counts = self.within_counts(rows)
+        else:
+            kept = np.intersect1d(old, rows, assume_unique=True)
+            counts = old_counts.copy()
+            # only rows changed are compared, against cached tiles where available and
+            # directly otherwise, so the cost is O(changed x n) however few tiles are cached
+            counts -= self.cross_counts(removed, kept) + self.within_counts(removed, fill_tiles=False)
+            counts += self.cross_counts(added, kept) + self.within_counts(added, fill_tiles=False)
+
+        self._sessions[session] = (rows, counts)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return counts.copy()
+
+
+_caches = Registry(MAX_DATASETS)
+
+
+def get_similarity_cache(key, fps_loader):
+    '''
+    Return the SimilarityCache for the dataset identified by key, building it with
+    fps_loader() on a miss. Only the MAX_DATASETS most recently used datasets are kept.
+    '''
+    return _caches.get_or_build(key, lambda: SimilarityCache(fps_loader()))
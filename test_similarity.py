@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from similarity import SimilarityCache
+
+N_BINS = 20
+
+
+def random_fps(n, n_bytes=8, seed=0):
+    return np.random.RandomState(seed).randint(0, 256, size=(n, n_bytes), dtype=np.uint8)
+
+
+def brute_force_counts(fps, rows):
+    bits = np.unpackbits(fps[rows], axis=1).astype(np.float32)
+    n_set = bits.sum(axis=1)
+
+    intersection = bits @ bits.T
+    union = n_set[:, None] + n_set[None, :] - intersection
+    similarity = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+    bins = np.minimum(similarity * N_BINS, N_BINS - 1).astype(np.uint8)
+
+    return np.bincount(bins[np.triu_indices(len(rows), k=1)], minlength=N_BINS)
+
+
+@pytest.mark.parametrize('max_tiles', [1000, 2], ids=['cached', 'evicting'])
+def test_incremental_updates_match_brute_force(max_tiles):
+    fps = random_fps(70)
+    cache = SimilarityCache(fps, n_bins=N_BINS, tile_size=8, max_tiles=max_tiles, max_sessions=2)
+    rng = np.random.RandomState(1)
+
+    # interleaved sessions, with a third evicting the least recently used one
+    selections = {}
+    for _ in range(60):
+        session = rng.choice(['a', 'b', 'c'])
+        rows = selections.get(session, rng.choice(70, 40, replace=False))
+        n_changed = rng.randint(1, 6)
+        removed = rng.choice(rows, n_changed, replace=False)
+        added = rng.choice(np.setdiff1d(np.arange(70), rows), n_changed, replace=False)
+        rows = np.union1d(np.setdiff1d(rows, removed), added)
+        selections[session] = rows
+
+        counts = cache.update(rows, session)
+        np.testing.assert_array_equal(counts, brute_force_counts(fps, rows))
+
+    assert len(cache._tiles) <= max_tiles
+
+
+def test_empty_and_single_row_selections():
+    fps = random_fps(20)
+    cache = SimilarityCache(fps, n_bins=N_BINS, tile_size=8)
+
+    for rows in ([], [3], list(range(20)), [5]):
+        np.testing.assert_array_equal(cache.update(rows), brute_force_counts(fps, np.asarray(rows, dtype=np.int64)))